@@ -0,0 +1,7 @@
+-- Чекпоинт дельта-синхронизации wb_cards_dimensions_sync.py:
+-- одна строка на синхронизацию, last_updated_at — максимальный updated_at_wb
+-- из последнего успешного прогона.
+create table if not exists public.sync_state (
+    name            text primary key,
+    last_updated_at timestamptz not null
+);
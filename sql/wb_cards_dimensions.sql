@@ -0,0 +1,6 @@
+-- Уникальность nm_id для upsert'а из wb_cards_dimensions_sync.py
+-- (on_conflict=nm_id + Prefer: resolution=merge-duplicates).
+-- Без неё PostgREST отклоняет каждый батч с 400 (42P10).
+-- Применить до деплоя; если в таблице уже есть дубли nm_id, сначала удалить их.
+create unique index if not exists wb_cards_dimensions_nm_id_key
+    on public.wb_cards_dimensions (nm_id);
@@ -1,6 +1,14 @@
+import argparse
+import gzip
 import os
-import time
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from itertools import islice
+
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # ==========
@@ -10,8 +18,23 @@ SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
 SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 WB_API_TOKEN = os.environ["WB_API_TOKEN_CONTENT"]
 
+# Сжимать ли тела upsert'ов gzip'ом: шлюз перед PostgREST должен
+# понимать Content-Encoding: gzip, поэтому включается явно (=1).
+# Сжатие ответов отдельно включать не нужно: requests и так шлёт
+# Accept-Encoding: gzip, deflate и распаковывает ответы сам
+SUPABASE_GZIP_REQUESTS = os.environ.get("SUPABASE_GZIP_REQUESTS") == "1"
+
 SUPABASE_REST_URL = f"{SUPABASE_URL}/rest/v1"
 
+# Сколько батчей upsert'им в Supabase одновременно (не больше pool_maxsize сессии)
+INSERT_WORKERS = 8
+
+# Ключ строки с чекпоинтом дельта-синхронизации в таблице sync_state
+SYNC_STATE_NAME = "wb_cards_dimensions"
+
+# Тела меньше этого размера не сжимаем — выигрыша почти нет
+GZIP_MIN_BYTES = 8 * 1024
+
 # Заголовки для Supabase REST
 SUPABASE_HEADERS = {
     "apikey": SUPABASE_SERVICE_ROLE_KEY,
@@ -24,79 +47,189 @@ SUPABASE_HEADERS = {
 # ==========
 WB_URL = "https://content-api.wildberries.ru/content/v2/get/cards/list"
 
+WB_HEADERS = {
+    "Authorization": WB_API_TOKEN,
+    "Content-Type": "application/json",
+}
+
 
-def iter_wb_cards(limit: int = 100):
+# ==========
+# HTTP-сессии
+# ==========
+
+def make_session(
+    headers: dict,
+    allowed_methods: frozenset[str],
+    backoff_factor: float = 0.3,
+) -> requests.Session:
     """
-    Генератор, который проходится по всем карточкам WB через пагинацию.
+    Сессия с keep-alive и пулом соединений: TCP + TLS handshake делается
+    один раз, дальше сокет переиспользуется для всех страниц / батчей.
+    Временные ошибки (429/5xx) ретраятся с backoff, Retry-After уважается.
+    Ретраятся только allowed_methods — запросы, повтор которых безопасен.
     """
-    headers = {
-        "Authorization": WB_API_TOKEN,
-        "Content-Type": "application/json",
-    }
+    retry = Retry(
+        total=5,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=allowed_methods,
+        raise_on_status=False,  # последний ответ отдаём в raise_for_status()
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# POST к WB cards/list — чтение, ретраить безопасно
+wb_session = make_session(WB_HEADERS, allowed_methods=frozenset({"POST"}))
+# Supabase: все POST'ы — upsert (merge-duplicates по nm_id / name), а DELETE
+# идёт по фильтру, поэтому повтор после таймаута / 5xx не создаёт дублей.
+# Между батчами нет паузы, поэтому на 429 отступаем дольше
+sb_session = make_session(
+    SUPABASE_HEADERS,
+    allowed_methods=frozenset({"GET", "POST", "DELETE"}),
+    backoff_factor=0.5,
+)
+
+
+def fetch_wb_page(payload: dict) -> dict:
+    """
+    Один запрос к cards/list.
+    """
+    resp = wb_session.post(WB_URL, data=msgspec.json.encode(payload), timeout=60)
+    resp.raise_for_status()
+    return msgspec.json.decode(resp.content)
+
+
+def parse_wb_ts(value: str | None) -> datetime | None:
+    """
+    ISO-время из WB / Supabase ("...Z" или "...+00:00") → datetime.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def is_older_than(card: dict, since: datetime) -> bool:
+    """
+    Карточка обновлена раньше since (без updatedAt — считаем, что нет).
+    """
+    updated_at = parse_wb_ts(card.get("updatedAt"))
+    return updated_at is not None and updated_at < since
+
 
+def iter_wb_cards(limit: int = 100, since: datetime | None = None):
+    """
+    Генератор, который проходится по всем карточкам WB через пагинацию.
+
+    WB отдаёт карточки от новых к старым (updatedAt desc), поэтому при
+    заданном since генератор останавливается на первой карточке старше него.
+
+    Курсор WB (updatedAt + nmID) известен только из ответа предыдущей
+    страницы, поэтому страницы нельзя запрашивать параллельно. Вместо этого
+    следующая страница запрашивается в фоне, пока потребитель обрабатывает
+    карточки текущей.
+    """
     cursor = {"limit": limit}
     filter_ = {
         "withPhoto": -1,  # можно добавить textSearch / brand / objectIDs при необходимости
     }
 
-    while True:
-        payload = {
-            "settings": {
-                "cursor": cursor,
-                "filter": filter_,
-                "sort": {
-                    "ascending": False
-                },
-            }
-        }
+    # между страницами меняется только курсор, остальной payload общий
+    settings = {
+        "cursor": cursor,
+        "filter": filter_,
+        "sort": {
+            "ascending": False
+        },
+    }
+    payload = {"settings": settings}
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        future = prefetcher.submit(fetch_wb_page, payload)
 
-        resp = requests.post(WB_URL, headers=headers, json=payload, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
+        while future is not None:
+            data = future.result()
+            future = None
 
-        cards = data.get("cards", []) or []
-        if not cards:
-            break
+            cards = data.get("cards", []) or []
+            if not cards:
+                break
 
-        for card in cards:
-            yield card
+            cur = data.get("cursor") or {}
+            total = cur.get("total", 0)
+            limit = cur.get("limit", cursor.get("limit", limit))
 
-        cur = data.get("cursor") or {}
-        total = cur.get("total", 0)
-        limit = cur.get("limit", cursor.get("limit", limit))
+            # дальше только карточки старше since — следующая страница не нужна
+            reached_since = since is not None and is_older_than(cards[-1], since)
 
-        # если total < limit — всё выгрузили
-        if total < limit:
-            break
+            # если total < limit — всё выгрузили, иначе сразу запрашиваем следующую страницу
+            if total >= limit and not reached_since:
+                cursor = {
+                    "updatedAt": cur.get("updatedAt"),
+                    "nmID": cur.get("nmID"),
+                    "limit": limit,
+                }
+                # предыдущий запрос уже завершён, payload можно менять
+                settings["cursor"] = cursor
+                future = prefetcher.submit(fetch_wb_page, payload)
 
-        # готовим курсор для следующего запроса
-        cursor = {
-            "updatedAt": cur.get("updatedAt"),
-            "nmID": cur.get("nmID"),
-            "limit": limit,
-        }
+            for card in cards:
+                if since is not None and is_older_than(card, since):
+                    return
+                yield card
 
 
-def build_row_from_card(card: dict) -> dict | None:
+class Row(msgspec.Struct):
+    """
+    Строка таблицы wb_cards_dimensions. Имена полей совпадают с колонками,
+    поэтому msgspec.json.encode(list[Row]) — готовое тело для PostgREST.
+    """
+    nm_id: int
+    vendor_code: str | None
+    brand: str | None
+    object_name: str | None
+    length_cm: float
+    width_cm: float
+    height_cm: float
+    weight_brutto_kg: float | None
+    volume_liters: float
+    updated_at_wb: str | None
+    # обязателен: при upsert'е (merge-duplicates) default now() срабатывает
+    # только для новых nm_id, а по fetched_at delete_stale_rows() чистит таблицу
+    fetched_at: str
+
+
+def build_row_from_card(card: dict, fetched_at: str) -> Row | None:
     """
     Собираем одну строку для вставки в таблицу wb_cards_dimensions.
     Если нет габаритов — возвращаем None.
     """
-    nm_id = card.get("nmID")
-    vendor_code = card.get("vendorCode")
-    brand = card.get("brand")
-    object_name = card.get("object") or card.get("objectName")
+    # локальные алиасы .get — вызывается на каждую карточку каталога
+    g = card.get
+    d = (g("dimensions") or {}).get
 
-    dimensions = card.get("dimensions") or {}
+    nm_id = g("nmID")
+    vendor_code = g("vendorCode")
+    brand = g("brand")
+    object_name = g("object") or g("objectName")
 
-    length = dimensions.get("length")
-    width = dimensions.get("width")
-    height = dimensions.get("height")
-    weight_brutto = dimensions.get("weightBrutto")
-    updated_at_wb = card.get("updatedAt")
+    length = d("length")
+    width = d("width")
+    height = d("height")
+    weight_brutto = d("weightBrutto")
+    updated_at_wb = g("updatedAt")
 
     # если габариты не заданы — пропускаем
-    if not all([length, width, height]):
+    if length is None or width is None or height is None:
         return None
 
     try:
@@ -106,92 +239,193 @@ def build_row_from_card(card: dict) -> dict | None:
     except (TypeError, ValueError):
         return None
 
-    volume_liters = (length * width * height) / 1000.0  # см³ → литры
+    # нулевые (и nan) габариты тоже пропускаем
+    if not (length > 0 and width > 0 and height > 0):
+        return None
 
-    row = {
-        "nm_id": nm_id,
-        "vendor_code": vendor_code,
-        "brand": brand,
-        "object_name": object_name,
-        "length_cm": round(length, 2),
-        "width_cm": round(width, 2),
-        "height_cm": round(height, 2),
-        "weight_brutto_kg": float(weight_brutto) if weight_brutto is not None else None,
-        "volume_liters": round(volume_liters, 3),
-        "updated_at_wb": updated_at_wb,
-        # fetched_at проставится default now() на стороне БД
-    }
+    volume_liters = (length * width * height) / 1000.0  # см³ → литры
 
-    return row
+    return Row(
+        nm_id=nm_id,
+        vendor_code=vendor_code,
+        brand=brand,
+        object_name=object_name,
+        length_cm=round(length, 2),
+        width_cm=round(width, 2),
+        height_cm=round(height, 2),
+        weight_brutto_kg=float(weight_brutto) if weight_brutto is not None else None,
+        volume_liters=round(volume_liters, 3),
+        updated_at_wb=updated_at_wb,
+        fetched_at=fetched_at,
+    )
 
 
 # ==========
 # Supabase helper'ы
 # ==========
 
-def delete_all_rows():
+def delete_stale_rows(fetched_before: str):
     """
-    Полностью очищаем таблицу wb_cards_dimensions.
-    Supabase REST требует фильтр, поэтому ставим nm_id=gt.0 (nmID всегда > 0).
+    Удаляем карточки, которых не было в текущей выгрузке WB:
+    все строки, обновлённые в этом запуске, имеют fetched_at >= fetched_before.
     """
     url = f"{SUPABASE_REST_URL}/wb_cards_dimensions"
-    params = {"nm_id": "gt.0"}
-    print("Deleting old data from wb_cards_dimensions...")
-    resp = requests.delete(url, headers=SUPABASE_HEADERS, params=params, timeout=60)
+    params = {"fetched_at": f"lt.{fetched_before}"}
+    print("Deleting stale rows from wb_cards_dimensions...")
+    resp = sb_session.delete(url, params=params, timeout=60)
     resp.raise_for_status()
     print("Delete status:", resp.status_code)
 
 
-def insert_rows_batch(batch: list[dict]):
+def insert_rows_batch(batch: list[Row]):
     """
-    Вставка батча строк в wb_cards_dimensions.
+    Upsert батча строк в wb_cards_dimensions по nm_id
+    (нужен unique index на nm_id — см. sql/wb_cards_dimensions.sql).
     """
     if not batch:
         return
 
     url = f"{SUPABASE_REST_URL}/wb_cards_dimensions"
+    params = {"on_conflict": "nm_id"}
     headers = {
-        **SUPABASE_HEADERS,
-        "Prefer": "return=none",  # нам не нужно тело ответа
+        # существующие nm_id обновляем, тело ответа нам не нужно
+        "Prefer": "resolution=merge-duplicates,return=none",
     }
-    resp = requests.post(url, headers=headers, json=batch, timeout=60)
+    body = msgspec.json.encode(batch)
+    if SUPABASE_GZIP_REQUESTS and len(body) > GZIP_MIN_BYTES:
+        # уровень 1 почти бесплатен по CPU и всё равно сжимает в разы
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    resp = sb_session.post(url, headers=headers, params=params, data=body, timeout=60)
     resp.raise_for_status()
 
 
-def refresh_supabase_table():
+def load_sync_state() -> datetime | None:
     """
-    Полное обновление таблицы:
-    1) тянем все карточки с габаритами
-    2) очищаем таблицу
-    3) вставляем новые данные батчами
+    Чекпоинт прошлой успешной синхронизации — максимальный updated_at_wb.
+    Таблица sync_state создаётся из sql/sync_state.sql; пока её нет
+    (PostgREST отвечает 404), считаем, что чекпоинта нет — будет полный прогон.
     """
-    print("Fetching cards from Wildberries...")
+    url = f"{SUPABASE_REST_URL}/sync_state"
+    params = {"name": f"eq.{SYNC_STATE_NAME}", "select": "last_updated_at"}
+    resp = sb_session.get(url, params=params, timeout=60)
+    if resp.status_code == 404:
+        print("Table sync_state not found (see sql/sync_state.sql), running full refresh")
+        return None
+    resp.raise_for_status()
+    state = msgspec.json.decode(resp.content)
+    if not state:
+        return None
+    return parse_wb_ts(state[0].get("last_updated_at"))
 
-    rows: list[dict] = []
 
-    for card in iter_wb_cards(limit=100):
-        row = build_row_from_card(card)
-        if row:
-            rows.append(row)
+def save_sync_state(last_updated_at: str):
+    """
+    Сохраняем чекпоинт после успешной синхронизации.
+    Если таблицы sync_state нет — только предупреждаем: данные уже залиты.
+    """
+    url = f"{SUPABASE_REST_URL}/sync_state"
+    params = {"on_conflict": "name"}
+    headers = {
+        "Prefer": "resolution=merge-duplicates,return=none",
+    }
+    body = msgspec.json.encode({
+        "name": SYNC_STATE_NAME,
+        "last_updated_at": last_updated_at,
+    })
+    resp = sb_session.post(url, headers=headers, params=params, data=body, timeout=60)
+    if resp.status_code == 404:
+        print("Table sync_state not found (see sql/sync_state.sql), sync state not saved")
+        return
+    resp.raise_for_status()
+    print(f"Sync state saved: last_updated_at={last_updated_at}")
 
-    print(f"Total rows with dimensions: {len(rows)}")
 
-    # Очищаем таблицу
-    delete_all_rows()
+def iter_rows(fetched_at: str, limit: int = 100, since: datetime | None = None):
+    """
+    Поток строк с габаритами прямо из пагинации WB, без накопления в памяти.
+    """
+    for card in iter_wb_cards(limit=limit, since=since):
+        row = build_row_from_card(card, fetched_at)
+        if row is not None:
+            yield row
 
-    # Вставляем батчами
-    batch_size = 500
-    total = len(rows)
-    print("Inserting new data into wb_cards_dimensions...")
 
-    for i in range(0, total, batch_size):
-        batch = rows[i: i + batch_size]
-        print(f"Inserting batch {i}..{i + len(batch) - 1}")
-        insert_rows_batch(batch)
-        time.sleep(0.2)
+def refresh_supabase_table(full: bool = False):
+    """
+    Обновление таблицы без окна с пустой таблицей:
+    1) тянем карточки с габаритами и сразу upsert'им их батчами —
+       в памяти держим не больше одного батча
+    2) при полном обновлении удаляем строки, которых не было в выгрузке
+       (fetched_at старше начала запуска)
+    3) сохраняем чекпоинт — максимальный updated_at_wb
+
+    По умолчанию работает в дельта-режиме: тянет только карточки, изменённые
+    после чекпоинта. Удалённые в WB карточки так не видны, поэтому нужен
+    периодический полный прогон (full=True). Без чекпоинта — всегда полный.
+    """
+    sync_started_at = datetime.now(timezone.utc).isoformat()
+
+    since = None if full else load_sync_state()
+    full = since is None
+    if full:
+        print("Full refresh")
+    else:
+        print(f"Delta refresh: cards updated since {since.isoformat()}")
+
+    # Upsert'им батчами по мере выгрузки из WB, несколько POST'ов параллельно
+    batch_size = 5000
+    total = 0
+    newest: tuple[datetime, str] | None = None
+    print("Fetching cards from Wildberries and upserting into wb_cards_dimensions...")
+
+    rows = iter_rows(sync_started_at, limit=100, since=since)
+    with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as pool:
+        pending = set()
+        batch = list(islice(rows, batch_size))
+        while batch:
+            # не держим в памяти больше INSERT_WORKERS батчей
+            if len(pending) >= INSERT_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            for row in batch:
+                updated_at = parse_wb_ts(row.updated_at_wb)
+                if updated_at is not None and (newest is None or updated_at > newest[0]):
+                    newest = (updated_at, row.updated_at_wb)
+
+            print(f"Upserting batch {total}..{total + len(batch) - 1}")
+            pending.add(pool.submit(insert_rows_batch, batch))
+            total += len(batch)
+            batch = list(islice(rows, batch_size))
+
+        done, _ = wait(pending, return_when=FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+
+    print(f"Total rows with dimensions: {total}")
+
+    # Чистим карточки, которых больше нет в WB
+    if full:
+        delete_stale_rows(sync_started_at)
+
+    if newest is not None:
+        save_sync_state(newest[1])
 
     print("Done.")
 
 
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Синхронизация габаритов карточек WB в Supabase")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="полное обновление: игнорировать чекпоинт и удалить исчезнувшие карточки",
+    )
+    args = parser.parse_args(argv)
+    refresh_supabase_table(full=args.full)
+
+
 if __name__ == "__main__":
-    refresh_supabase_table()
+    main()